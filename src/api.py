@@ -1,20 +1,88 @@
 import os
-import json
+import sys
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import orjson
+import gzip
+import hashlib
+import pickle
+import psutil
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from langgraph.graph import StateGraph
 from typing import TypedDict, Literal
-from datetime import datetime
+from time import time_ns
 from pydantic import BaseModel
 
 # 导入核心图逻辑
 from . import core_graph 
 
 # --- FastAPI Setup ---
+
+# 编译产物的磁盘缓存：冷启动变成一次文件加载，而不是每个 worker 重新 build+compile。
+# 文件名带上 core_graph.py 内容的摘要做失效键：拓扑一变旧缓存自然失配，
+# 不会在部署后静默加载过期的图
+def _graph_cache_path() -> str:
+    src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "core_graph.py")
+    with open(src_path, "rb") as f:
+        digest = hashlib.md5(f.read()).hexdigest()[:12]
+    return os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        f"graph-{digest}.pkl",
+    )
+
+_GRAPH_CACHE_PATH = _graph_cache_path()
+
+def _load_companion_graph():
+    """优先从磁盘缓存加载已编译的图；缓存缺失或不可用时重建并尝试写回"""
+    try:
+        with open(_GRAPH_CACHE_PATH, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        graph = core_graph.build_companion_graph()
+        try:
+            with open(_GRAPH_CACHE_PATH, "wb") as f:
+                pickle.dump(graph, f)
+        except Exception:
+            pass  # 编译产物包含不可 pickle 的成员时跳过缓存
+        return graph
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """每个 worker 启动时加载图、可选预热，并启动后台指标采样"""
+    global companion_graph
+    companion_graph = _load_companion_graph()
+    if os.getenv("GRAPH_WARMUP") == "1":
+        # 预热一次，触发 pregel 内部的惰性初始化（会发起真实 LLM 调用，默认关闭）
+        try:
+            await companion_graph.ainvoke(core_graph.CompanionState(
+                user_input="你好",
+                user_input_lc="你好",
+                current_personality="mentor",
+                conversation_history=[],
+                detected_emotion=core_graph.Emotion.neutral,
+                should_use_skill=False,
+                skill_to_use="",
+                skill_result="",
+                final_response="",
+            ))
+        except Exception as e:
+            print(f"Graph warmup failed: {e}")
+    if os.getenv("HTTP2_PROBE") == "1":
+        # 探测到 LLM 端点的连接是否协商到 HTTP/2（失败只告警，不阻断启动）
+        await core_graph.probe_http2()
+    sampler = asyncio.create_task(_sample_metrics())
+    yield
+    sampler.cancel()
+    await core_graph.aclose_clients()
+
 app = FastAPI(
     title="Companion Robot Cognitive API",
     description="Real-time WebSocket API for streaming LangGraph execution trace with dynamic configuration.",
+    lifespan=lifespan,
 )
 
 # 允许跨域访问，方便前端开发
@@ -26,8 +94,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 编译 LangGraph
-companion_graph = core_graph.build_companion_graph()
+# JSON 载荷键名重复、中文 UTF-8 文本多，gzip 通常能压 3-5 倍；
+# 静态配置端点返回预压缩字节（带 Content-Encoding），中间件会跳过它们
+app.add_middleware(GZipMiddleware, minimum_size=256)
+
+# 编译后的 LangGraph，由 lifespan 在启动时填充
+companion_graph = None
 PERSONALITY_MASKS = core_graph.PERSONALITY_MASKS
 
 # --- System Configuration Models ---
@@ -86,18 +158,18 @@ def get_system_config() -> SystemConfig:
     # 节点配置（从 core_graph 中提取）
     nodes = [
         NodeConfig(id="receive_input", label="接收输入", type="input", angle=0),
-        NodeConfig(id="analyze_emotion", label="情绪分析", type="processor", angle=60),
-        NodeConfig(id="decide_skill", label="技能决策", type="processor", angle=120),
-        NodeConfig(id="execute_skill", label="执行技能", type="processor", angle=180),
-        NodeConfig(id="generate_response", label="生成回复", type="processor", angle=240),
-        NodeConfig(id="update_history", label="更新历史", type="output", angle=300),
+        NodeConfig(id="classify", label="理解分类", type="processor", angle=72),
+        NodeConfig(id="execute_skill", label="执行技能", type="processor", angle=144),
+        NodeConfig(id="generate_response", label="生成回复", type="processor", angle=216),
+        NodeConfig(id="update_history", label="更新历史", type="output", angle=288),
     ]
-    
+
     # 连接配置
     connections = [
-        ConnectionConfig(from_node="receive_input", to_node="analyze_emotion", color="#00BFFF"),
-        ConnectionConfig(from_node="analyze_emotion", to_node="decide_skill", color="#00BFFF"),
-        ConnectionConfig(from_node="decide_skill", to_node="execute_skill", color="#00BFFF"),
+        ConnectionConfig(from_node="receive_input", to_node="classify", color="#00BFFF"),
+        ConnectionConfig(from_node="classify", to_node="execute_skill", color="#00BFFF"),
+        # 条件边的旁路：不需要技能时 classify 直达 generate_response
+        ConnectionConfig(from_node="classify", to_node="generate_response", color="#00BFFF"),
         ConnectionConfig(from_node="execute_skill", to_node="generate_response", color="#9370DB"),
         ConnectionConfig(from_node="generate_response", to_node="update_history", color="#9370DB"),
     ]
@@ -126,14 +198,32 @@ def get_system_config() -> SystemConfig:
         personalities=personalities
     )
 
+# 配置在进程生命周期内是静态的：启动时构建一次并序列化成 bytes，
+# 请求时直接返回，省掉每次的 Pydantic 构建和 model_dump()。
+# gzip 也在启动时压缩一次，请求路径上零压缩成本
+_SYSTEM_CONFIG_BYTES = orjson.dumps(get_system_config().model_dump())
+_SYSTEM_CONFIG_GZ = gzip.compress(_SYSTEM_CONFIG_BYTES, 6)
+_SYSTEM_CONFIG_ETAG = f'"{hashlib.md5(_SYSTEM_CONFIG_BYTES).hexdigest()}"'
+
+def _static_json_response(request: Request, raw: bytes, gz: bytes, etag: str) -> Response:
+    """返回预渲染的静态 JSON：命中 ETag 则 304，客户端支持 gzip 则返回预压缩字节"""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=gz, media_type="application/json", headers=headers)
+    return Response(content=raw, media_type="application/json", headers=headers)
+
 @app.get("/api/system-config")
-async def system_config():
+async def system_config(request: Request):
     """
     返回系统配置
     前端在初始化时调用此端点，获取节点、连接、情绪等配置
     """
-    config = get_system_config()
-    return config.model_dump()
+    return _static_json_response(
+        request, _SYSTEM_CONFIG_BYTES, _SYSTEM_CONFIG_GZ, _SYSTEM_CONFIG_ETAG
+    )
 
 # --- Panels Configuration Endpoint ---
 
@@ -180,81 +270,208 @@ def get_panels_config() -> PanelsConfig:
         maxWidth="400px"
     )
 
+# 同 system-config：静态内容，启动时预渲染 + 预压缩
+_PANELS_CONFIG_BYTES = orjson.dumps(get_panels_config().model_dump())
+_PANELS_CONFIG_GZ = gzip.compress(_PANELS_CONFIG_BYTES, 6)
+_PANELS_CONFIG_ETAG = f'"{hashlib.md5(_PANELS_CONFIG_BYTES).hexdigest()}"'
+
 @app.get("/api/panels-config")
-async def panels_config():
+async def panels_config(request: Request):
     """
     返回面板配置
     前端在初始化时调用此端点，获取要显示的所有面板
     """
-    config = get_panels_config()
-    return config.model_dump()
+    return _static_json_response(
+        request, _PANELS_CONFIG_BYTES, _PANELS_CONFIG_GZ, _PANELS_CONFIG_ETAG
+    )
 
 # --- Panel Data Endpoint (for real-time updates) ---
 
+# 指标由后台任务每秒采样一次并预渲染成 bytes，请求处理器只读缓存。
+# psutil.cpu_percent(interval=None) 非阻塞（返回自上次调用以来的增量），
+# 避免旧实现 interval=0.1 在每个请求中阻塞事件循环 100ms，
+# 并让 N 个并发轮询的客户端共享同一份采样
+_METRICS_REFRESH = 1.0
+_metrics_cache = {"cpu": 0.0, "memory": 0.0, "network": 0}
+
+def _render_panels_data() -> bytes:
+    return orjson.dumps({
+        # LLM 状态
+        "llm-status": {
+            "status": "connected",
+            "latency": 45,
+        },
+        # 系统指标
+        "system-metrics": dict(_metrics_cache),
+        # 事件日志（示例）
+        "event-logs": {
+            "logs": [
+                {"level": "info", "message": "系统启动完成", "timestamp": "14:30:15"},
+                {"level": "info", "message": "WebSocket 连接已建立", "timestamp": "14:30:16"},
+            ]
+        },
+        # 内存使用
+        "memory-usage": {
+            "conversationSize": 1024 * 50,  # 50KB
+            "cacheSize": 1024 * 100,  # 100KB
+        },
+    })
+
+_panels_data_bytes = _render_panels_data()
+
+async def _sample_metrics():
+    global _panels_data_bytes
+    psutil.cpu_percent(interval=None)  # 首次调用建立采样基准
+    while True:
+        _metrics_cache["cpu"] = psutil.cpu_percent(interval=None)
+        _metrics_cache["memory"] = psutil.virtual_memory().percent
+        _panels_data_bytes = _render_panels_data()
+        await asyncio.sleep(_METRICS_REFRESH)
+
 @app.get("/api/panels-data")
 async def panels_data():
     """
     返回所有面板的实时数据
     前端可以定期调用此端点获取最新数据
     """
-    import psutil
-    
-    # LLM 状态
-    llm_status = {
-        "status": "connected",
-        "latency": 45,
-    }
-    
-    # 系统指标
-    system_metrics = {
-        "cpu": psutil.cpu_percent(interval=0.1),
-        "memory": psutil.virtual_memory().percent,
-        "network": 0,  # 可以扩展为实际网络使用
-    }
-    
-    # 事件日志（示例）
-    event_logs = {
-        "logs": [
-            {"level": "info", "message": "系统启动完成", "timestamp": "14:30:15"},
-            {"level": "info", "message": "WebSocket 连接已建立", "timestamp": "14:30:16"},
-        ]
-    }
-    
-    # 内存使用
-    memory_usage = {
-        "conversationSize": 1024 * 50,  # 50KB
-        "cacheSize": 1024 * 100,  # 100KB
-    }
-    
-    return {
-        "llm-status": llm_status,
-        "system-metrics": system_metrics,
-        "event-logs": event_logs,
-        "memory-usage": memory_usage,
-    }
+    return Response(content=_panels_data_bytes, media_type="application/json")
 
 # --- WebSocket Endpoint ---
 
+# 出站队列上限（背压阈值）与单帧最多合并的事件数
+_SEND_QUEUE_MAX = 64
+_MAX_BATCH = 32
+
+# 每个会话保留的最近对话轮数
+_HISTORY_MAXLEN = 20
+
+# 单条入站消息的上限：超过直接丢弃，不进 JSON 解析
+_MAX_MESSAGE_BYTES = 8192
+
+# 节点事件里只转发这些状态键：有界、可 JSON 序列化，
+# 不像 str(state_update) 那样物化整个状态的 repr 还产出非 JSON 内容
+_SAFE_KEYS = {"detected_emotion", "should_use_skill", "skill_to_use",
+              "skill_result", "final_response"}
+# final_response 可能很长，预览截断到该长度
+_PREVIEW_CHARS = 200
+
+async def _send(ws: WebSocket, obj) -> None:
+    """用 orjson 序列化为 bytes 并以二进制帧发送，跳过 stdlib json 和文本帧的 UTF-8 编码"""
+    await ws.send_bytes(orjson.dumps(obj))
+
+def _now_us() -> int:
+    """当前时间戳（微秒，int）：比 datetime.now().isoformat() 便宜得多，
+    orjson 序列化 int 零额外分配；格式化交给前端"""
+    return time_ns() // 1000
+
+@dataclass(slots=True)
+class NodeEvent:
+    """节点执行事件。
+
+    槽位化的单对象替代每步临时构造的多层 dict（外层 + metadata），
+    orjson 对 dataclass 有原生序列化快路径，字段直接平铺到 JSON 对象。
+    """
+    node_id: str
+    state_update: dict
+    ts: int
+    emotion: str | None = None
+    response_preview: str | None = None
+    type: str = "node_executed"
+
+def _node_event(node_name: str, state_update: dict) -> NodeEvent:
+    """构造自描述的节点执行事件（只投影已知键，显式截断长字段）"""
+    state_preview = {k: state_update[k] for k in state_update.keys() & _SAFE_KEYS}
+    if "final_response" in state_preview:
+        state_preview["final_response"] = state_preview["final_response"][:_PREVIEW_CHARS]
+    final_response = state_update.get("final_response")
+    emotion = state_update.get("detected_emotion")
+    return NodeEvent(
+        node_id=node_name,
+        state_update=state_preview,
+        ts=_now_us(),
+        # 情绪与最终回复预览单独拎出，前端不必翻 state_update；
+        # 状态里的情绪是 IntEnum，线上格式还原成名字字符串
+        emotion=emotion.name if emotion is not None else None,
+        response_preview=final_response[:50] if final_response is not None else None,
+    )
+
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("WebSocket connected")
-    
-    # 初始化会话状态
+
+    # 初始化会话状态。历史用定长环形缓冲：长连接下内存有上界，
+    # 且每轮传入图的状态拷贝成本是常数而非 O(轮数)
     current_state = {
-        "conversation_history": [],
+        "conversation_history": deque(maxlen=_HISTORY_MAXLEN),
         "current_personality": "mentor",
     }
 
+    # 出站队列 + 单一发送协程：图执行（生产者）不再阻塞在 TCP drain 上，
+    # 发送端一次尽量多取几个事件合并成单帧。队列有上限：发送跟不上时
+    # put 自然阻塞，给图执行提供背压，内存有界
+    send_q: asyncio.Queue = asyncio.Queue(maxsize=_SEND_QUEUE_MAX)
+
+    async def _sender():
+        while True:
+            batch = [await send_q.get()]
+            while not send_q.empty() and len(batch) < _MAX_BATCH:
+                batch.append(send_q.get_nowait())
+            await _send(websocket, {"type": "batch", "events": batch})
+
+    sender = asyncio.create_task(_sender())
+
+    async def _q_put(event) -> None:
+        """入队出站事件；发送任务已退出时把它的失败抛回生产者。
+
+        不加这层，发送端挂掉（对端断开、事件序列化失败）后生产者会在
+        满队列的 put 上永久阻塞，永远回不到 receive_bytes 观察断连，
+        连接与在途的 LLM 流一起泄漏。
+        """
+        put = asyncio.ensure_future(send_q.put(event))
+        await asyncio.wait({put, sender}, return_when=asyncio.FIRST_COMPLETED)
+        if sender.done():
+            put.cancel()
+            sender.result()  # 正常情况下重抛发送任务的异常
+            raise RuntimeError("sender task exited")  # 防御：_sender 不会正常返回
+        await put
+
     try:
         while True:
-            # 1. 接收用户输入和人格选择
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            user_input = message.get("user_input", "").strip()
-            personality = message.get("personality", "mentor").strip().lower()
-            
+            # 1. 接收用户输入和人格选择（优先二进制帧 + orjson 解析，
+            # 省掉 stdlib 的 UTF-8 解码 + json.loads 双重扫描；
+            # 仍发文本帧的旧客户端同样接受——orjson 两种都能解析，
+            # 不能让意外的帧类型经 KeyError 拆掉整条连接）
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            data = frame.get("bytes")
+            if data is None:
+                data = frame.get("text")
+            if data is None:
+                continue
+            # 尺寸上限在解析之前检查：恶意的超大/深嵌套 JSON
+            # 不应有机会让解析器分配内存
+            if len(data) > _MAX_MESSAGE_BYTES:
+                continue
+            try:
+                message = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                continue
+            # 合法 JSON 不一定是对象，字段也不一定是字符串（123、"hi"、
+            # [...]）——这类畸形帧同样只是丢弃，不能让 .strip() 抛错
+            # 走到通用错误路径把整条连接拆掉
+            if not isinstance(message, dict):
+                continue
+            user_input = message.get("user_input", "")
+            personality = message.get("personality", "mentor")
+            if not isinstance(user_input, str) or not isinstance(personality, str):
+                continue
+
+            user_input = user_input.strip()
+            # intern 人格键：PERSONALITY_MASKS 等字典查找可走指针相等的快路径
+            personality = sys.intern(personality.strip().lower())
+
             if not user_input:
                 continue
 
@@ -264,9 +481,10 @@ async def websocket_endpoint(websocket: WebSocket):
             # 准备图的输入状态
             input_state = core_graph.CompanionState(
                 user_input=user_input,
+                user_input_lc="",  # 由 receive_input 节点填充
                 current_personality=personality,
                 conversation_history=current_state["conversation_history"],
-                detected_emotion="",
+                detected_emotion=core_graph.Emotion.neutral,
                 should_use_skill=False,
                 skill_to_use="",
                 skill_result="",
@@ -274,63 +492,53 @@ async def websocket_endpoint(websocket: WebSocket):
             )
 
             # 2. 发送开始信号（自描述事件）
-            await websocket.send_json({
+            await _q_put({
                 "type": "start",
-                "timestamp": datetime.now().isoformat(),
+                "ts": _now_us(),
                 "metadata": {
                     "input": user_input,
                     "personality": personality,
                 }
             })
 
-            # 3. 实时流式传输 LangGraph 执行轨迹
+            # 3. 实时流式传输执行轨迹
             full_response_buffer = ""
-            
-            # 使用 astream 实时获取每个节点的输出
-            async for step in companion_graph.astream(input_state):
-                node_name = list(step.keys())[0]
-                state_update = step[node_name]
-                
-                # 发送自描述的节点执行事件
-                event_data = {
-                    "type": "node_executed",
-                    "timestamp": datetime.now().isoformat(),
-                    "metadata": {
-                        "node_id": node_name,
-                        "state_update": str(state_update)[:100],  # 限制大小
-                    }
-                }
-                
-                # 特殊处理情绪检测
-                if "detected_emotion" in state_update:
-                    event_data["metadata"]["emotion"] = state_update["detected_emotion"]
-                
-                # 特殊处理最终回复
-                if "final_response" in state_update:
-                    full_response_buffer = state_update["final_response"]
-                    event_data["metadata"]["response_preview"] = full_response_buffer[:50]
-                
-                await websocket.send_json(event_data)
+
+            if core_graph.USE_FAST_PATH:
+                # 快速路径：直连流水线内联执行节点，绕过 pregel 调度，
+                # 每步完成后通过 emit 回调产出同样的节点事件
+                async def _emit(node_name: str, state_update: dict):
+                    await _q_put(_node_event(node_name, state_update))
+
+                # 回复生成期间逐分片推送，前端可以边收边渲染
+                async def _on_delta(chunk: str):
+                    await _q_put({"type": "response_delta", "ts": _now_us(), "delta": chunk})
+
+                final_state = await core_graph.run_fast(dict(input_state), _emit, _on_delta)
+                full_response_buffer = final_state["final_response"]
+            else:
+                # LangGraph 路径：使用 astream 实时获取每个节点的输出
+                async for step in companion_graph.astream(input_state):
+                    node_name = list(step.keys())[0]
+                    state_update = step[node_name]
+                    if "final_response" in state_update:
+                        full_response_buffer = state_update["final_response"]
+                    await _q_put(_node_event(node_name, state_update))
 
             # 4. 发送完整回复
-            await websocket.send_json({
+            await _q_put({
                 "type": "response_complete",
-                "timestamp": datetime.now().isoformat(),
+                "ts": _now_us(),
                 "metadata": {
                     "response": full_response_buffer,
                 }
             })
             
-            # 5. 更新历史记录
-            current_state["conversation_history"].append({
-                "user": user_input,
-                "bot": full_response_buffer
-            })
-
-            # 6. 发送结束信号
-            await websocket.send_json({
+            # 5. 发送结束信号（历史由图的 update_history 节点写入，
+            # 这里不再重复 append）
+            await _q_put({
                 "type": "end",
-                "timestamp": datetime.now().isoformat(),
+                "ts": _now_us(),
                 "metadata": {}
             })
 
@@ -339,19 +547,27 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         print(f"Error: {e}")
         try:
-            await websocket.send_json({
+            await _send(websocket, {
                 "type": "error",
-                "timestamp": datetime.now().isoformat(),
+                "ts": _now_us(),
                 "metadata": {
                     "message": str(e)
                 }
             })
         except:
             pass
+    finally:
+        sender.cancel()
 
 # --- Uvicorn 启动配置 ---
 if __name__ == "__main__":
     import uvicorn
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     os.chdir(project_root)
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop 事件循环 + httptools HTTP 解析器 + websockets 协议栈，
+    # 均为 C 实现，替代纯 Python 的默认栈。
+    # permessage-deflate 开启连接级压缩上下文：事件里重复的 JSON 键
+    # （type/ts/metadata/node_id...）在 LZ77 窗口里缩成几个字节
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools", ws="websockets",
+                ws_per_message_deflate=True, ws_max_size=65536)
@@ -1,46 +1,232 @@
 import os
+import re
+import ssl
 import json
+import asyncio
+import atexit
+import functools
+import logging
+import logging.handlers
+import queue
+import httpx
+import orjson
+import aiolimiter
+import tenacity
+from collections import deque
+from enum import IntEnum
 from typing import TypedDict, Literal
 from langgraph.graph import StateGraph, END
-from openai import OpenAI, AsyncOpenAI # 导入 AsyncOpenAI
+from openai import OpenAI, AsyncOpenAI, RateLimitError # 导入 AsyncOpenAI
 from dotenv import load_dotenv
 from datetime import datetime
 
+# libuv 实现的事件循环，per-await 调度开销比标准 selector 循环低数倍；
+# CLI 模式（asyncio.run）由这里接管，API 模式由 uvicorn 的 loop="uvloop" 接管
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:  # Windows 等平台没有 uvloop，退回标准事件循环
+    pass
+
 # 加载环境变量
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
 env_path = os.path.join(project_root, ".env")
 load_dotenv(dotenv_path=env_path, override=True)
 
+# 节点内一律用 logger 而非 print：print 是同步 stderr 写+flush，
+# 在事件循环上会把并发会话串行化；生产环境把级别设到 WARNING 即零开销
+log = logging.getLogger(__name__)
+
+def _setup_async_logging() -> None:
+    """日志记录经 QueueHandler 入队，由后台线程的 QueueListener 实际写出。
+
+    事件循环上只剩一次无锁入队，阻塞的写 syscall 全部移到线程里；
+    级别由 LOG_LEVEL 环境变量控制，默认 WARNING。
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.propagate = False
+    log.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
+
+_setup_async_logging()
+
+class Emotion(IntEnum):
+    """情绪标签。状态里存小整数而非自由字符串：历史增量是 8 字节而不是
+    每轮一个小字符串对象，比较是 C 级整数相等；只在拼提示词时还原成名字"""
+    happy = 0
+    sad = 1
+    angry = 2
+    neutral = 3
+
+# LLM 输出词 → 枚举的预构建映射，O(1) 查找
+_EMO_MAP = {e.name: e for e in Emotion}
+
 class CompanionState(TypedDict):
     user_input: str
+    user_input_lc: str  # user_input 的小写缓存，receive_input 写入一次，下游直接复用
     current_personality: Literal["mentor", "trickster", "guardian"]
-    conversation_history: list[dict]
-    detected_emotion: str
+    conversation_history: deque[dict]  # 定长环形缓冲（maxlen 由调用方设定），防止长会话无界增长
+    detected_emotion: Emotion
     should_use_skill: bool
     skill_to_use: str
     skill_result: str
     final_response: str
 
-def get_openai_client():
-    """返回同步客户端，用于兼容旧的 CLI 模式"""
+# 调用方未提供历史通道时，update_history 首轮创建的环形缓冲长度
+_DEFAULT_HISTORY_MAXLEN = 200
+
+# 客户端在进程内共享：每次 OpenAI()/AsyncOpenAI() 构造都会新建
+# httpx 传输层和 SSL 上下文（毫秒级），而节点每轮要调用三次 ——
+# 记忆化后构造只发生一次，之后是近乎免费的属性读取
+_SYNC_CLIENT = None
+_ASYNC_CLIENT = None
+
+# 显式注入带连接池的 httpx 传输层：所有 LLM 调用复用 TCP+TLS 连接
+# （keep-alive），而不是每个 SDK 默认传输各自握手；TLS 上下文只构建一次。
+# http2=True 让并发请求在单条 TLS 连接上多路复用，突发流量下
+# 每个进程只付一次握手，而不是按并发数各开一条连接
+_SHARED_SSL_CTX = ssl.create_default_context()
+_HTTPX_LIMITS = httpx.Limits(max_connections=1024, max_keepalive_connections=256)
+_HTTPX_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+def _resolve_base_url() -> str | None:
+    """规范化 OPENAI_BASE_URL：补全 /v1 后缀；未配置时返回 None，让 SDK 用官方默认端点"""
     base_url = os.getenv("OPENAI_BASE_URL")
-    if not base_url or not base_url.endswith("/v1"):
-        base_url = (base_url or "") + "/v1"
-    return OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        base_url=base_url
-    )
+    if not base_url:
+        return None
+    if not base_url.endswith("/v1"):
+        base_url += "/v1"
+    return base_url
+
+def get_openai_client():
+    """返回进程内共享的同步客户端，用于兼容旧的 CLI 模式"""
+    global _SYNC_CLIENT
+    if _SYNC_CLIENT is None:
+        _SYNC_CLIENT = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=_resolve_base_url(),
+            http_client=httpx.Client(
+                verify=_SHARED_SSL_CTX,
+                limits=_HTTPX_LIMITS,
+                timeout=_HTTPX_TIMEOUT,
+                http2=True,
+            ),
+        )
+        atexit.register(_SYNC_CLIENT.close)
+    return _SYNC_CLIENT
 
 def get_async_openai_client():
-    """返回异步客户端，用于新的 API 模式"""
-    base_url = os.getenv("OPENAI_BASE_URL")
-    if not base_url or not base_url.endswith("/v1"):
-        base_url = (base_url or "") + "/v1"
-    return AsyncOpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        base_url=base_url
-    )
+    """返回进程内共享的异步客户端，用于新的 API 模式"""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        _ASYNC_CLIENT = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=_resolve_base_url(),
+            http_client=httpx.AsyncClient(
+                verify=_SHARED_SSL_CTX,
+                limits=_HTTPX_LIMITS,
+                timeout=_HTTPX_TIMEOUT,
+                http2=True,
+            ),
+        )
+    return _ASYNC_CLIENT
+
+# LLM 调用的并发与速率护栏：并发上限让在途请求数贴近 provider 配额的
+# 最优点，令牌桶避免突发流量打出 429；双双超出时调用方自然排队（背压）
+_LLM_SEM = asyncio.Semaphore(int(os.getenv("LLM_MAX_INFLIGHT", "64")))
+_LLM_RATE = aiolimiter.AsyncLimiter(
+    max_rate=int(os.getenv("LLM_MAX_QPM", "500")), time_period=60
+)
+
+async def _limited_create(client, **kwargs):
+    """在信号量 + 令牌桶的护栏内发起 chat.completions.create；
+    429 时做带抖动的指数退避重试，避免整批请求同步重试再次打爆配额"""
+    async for attempt in tenacity.AsyncRetrying(
+        wait=tenacity.wait_exponential_jitter(initial=1, max=30),
+        stop=tenacity.stop_after_attempt(4),
+        retry=tenacity.retry_if_exception_type(RateLimitError),
+        reraise=True,
+    ):
+        with attempt:
+            async with _LLM_SEM, _LLM_RATE:
+                return await client.chat.completions.create(**kwargs)
+
+# 原生 HTTP 快路径：非流式的热调用不走 OpenAI SDK 的请求构建与
+# Pydantic 响应模型化（每次调用要物化几十个模型对象），而是用共享的
+# httpx 客户端直接 POST，orjson 编解码。端点和请求头在模块级预计算，
+# 每次调用只剩 body 的序列化。流式与 Batch 调用仍走 SDK
+_LLM_ENDPOINT = (_resolve_base_url() or "https://api.openai.com/v1") + "/chat/completions"
+_LLM_HEADERS = {
+    "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY', '')}",
+    "Content-Type": "application/json",
+}
+_RAW_HTTP: httpx.AsyncClient | None = None
+
+def _get_raw_http() -> httpx.AsyncClient:
+    global _RAW_HTTP
+    if _RAW_HTTP is None:
+        _RAW_HTTP = httpx.AsyncClient(
+            verify=_SHARED_SSL_CTX,
+            limits=_HTTPX_LIMITS,
+            timeout=_HTTPX_TIMEOUT,
+            http2=True,
+        )
+    return _RAW_HTTP
+
+async def probe_http2() -> bool:
+    """启动探针：向 LLM 端点发一次轻量请求，确认走的是 HTTP/2。
+
+    由 HTTP2_PROBE=1 时的 lifespan 调用；失败只告警不阻断启动——
+    网关不支持 h2 时 httpx 会自动回落到 HTTP/1.1，功能不受影响。
+    """
+    try:
+        r = await _get_raw_http().get(_LLM_ENDPOINT.rsplit("/chat/completions", 1)[0] + "/models",
+                                      headers=_LLM_HEADERS)
+        if r.http_version != "HTTP/2":
+            log.warning("http2_probe got=%s", r.http_version)
+            return False
+        return True
+    except Exception as e:
+        log.warning("http2_probe_failed err=%s", e)
+        return False
+
+def _is_rate_limited(e: BaseException) -> bool:
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429
+
+async def _llm(messages: list[dict], model: str = "gemini-3-flash-preview", **extra) -> str:
+    """轻量 chat completion 调用：返回首个 choice 的文本内容。
+
+    与 _limited_create 共用并发/速率护栏和 429 退避策略；
+    额外的请求体字段（response_format、prompt_cache_key 等）经 **extra 透传。
+    """
+    payload = orjson.dumps({"model": model, "messages": messages, **extra})
+    async for attempt in tenacity.AsyncRetrying(
+        wait=tenacity.wait_exponential_jitter(initial=1, max=30),
+        stop=tenacity.stop_after_attempt(4),
+        retry=tenacity.retry_if_exception(_is_rate_limited),
+        reraise=True,
+    ):
+        with attempt:
+            async with _LLM_SEM, _LLM_RATE:
+                r = await _get_raw_http().post(
+                    _LLM_ENDPOINT, content=payload, headers=_LLM_HEADERS
+                )
+            r.raise_for_status()
+            return orjson.loads(r.content)["choices"][0]["message"]["content"]
+
+async def aclose_clients():
+    """关闭共享的异步客户端（由 FastAPI lifespan 在停机时调用）"""
+    global _ASYNC_CLIENT, _RAW_HTTP
+    if _ASYNC_CLIENT is not None:
+        await _ASYNC_CLIENT.close()
+        _ASYNC_CLIENT = None
+    if _RAW_HTTP is not None:
+        await _RAW_HTTP.aclose()
+        _RAW_HTTP = None
 
 PERSONALITY_MASKS = {
     "mentor": {
@@ -57,106 +243,416 @@ PERSONALITY_MASKS = {
     },
 }
 
-# 所有节点改为异步函数
-async def node_receive_input(state: CompanionState) -> CompanionState:
-    print(f"\n[节点 1] 接收用户输入: {state['user_input']}")
-    return state
+# 人格系统消息预构建为不可变元组：热路径上免去逐层字典索引和
+# 每次调用的小字典分配，同时保证前缀字节级一致，可命中 prompt cache
+_PERSONALITY_PREFIX = {
+    k: ({"role": "system", "content": v["system_prompt"]},)
+    for k, v in PERSONALITY_MASKS.items()
+}
 
-async def node_analyze_emotion(state: CompanionState) -> CompanionState:
-    print(f"\n[节点 2] 分析用户情绪...")
-    client = get_async_openai_client()
-    try:
-        res = await client.chat.completions.create(
-            model="gemini-3-flash-preview",
-            messages=[{"role": "system", "content": "只返回一个词：happy, sad, angry, neutral"},
-                      {"role": "user", "content": state['user_input']}]
-        )
-        emotion = res.choices[0].message.content.strip().lower()
-    except Exception as e:
-        print(f"  ⚠️ 失败: {e}")
-        emotion = "neutral"
-    state["detected_emotion"] = emotion
-    print(f"  → 情绪: {emotion}")
-    return state
+# 用户消息模板：format_map 直接以 state 为映射填充，不走 f-string 重建
+_USER_CONTENT_TEMPLATE = "情绪:{detected_emotion}, 技能结果:{skill_result}\n用户说:{user_input}"
 
-async def node_decide_skill(state: CompanionState) -> CompanionState:
-    print(f"\n[节点 3] 决策技能...")
-    client = get_async_openai_client()
+def _fmt_user_content(state: CompanionState) -> str:
+    # 提示词里展示情绪的名字（"happy"），而不是枚举的整数值
+    return _USER_CONTENT_TEMPLATE.format_map(
+        {**state, "detected_emotion": state["detected_emotion"].name}
+    )
+
+# 分类调用的静态消息前缀提到模块级（元组，不可变）：每次请求都以
+# 字节级相同的前缀开头，provider 的 prompt cache 能复用前缀的 KV 计算，
+# 只为动态的用户输入做 prefill；prompt_cache_key 帮助路由到同一缓存分片
+_CLASSIFY_MESSAGES_PREFIX = (
+    {"role": "system", "content": (
+        '只返回 JSON 对象：{"emotion": "happy|sad|angry|neutral 之一", '
+        '"skill": "long_term_memory_store|shared_experience_fetch|none 之一"}'
+    )},
+)
+
+# 降级回复模板：LLM 调用失败时按 (人格, 情绪) 选用。
+# 模板是模块级普通字符串，只有被选中的那一条才执行 .format()，
+# 不会在每次调用时把整张表的插值都做一遍
+RESPONSE_TEMPLATES = {
+    ("mentor", "happy"): "很高兴看到你这么开心！保持这份能量，想想今天还能学到什么？{x}",
+    ("mentor", "sad"): "难过也是成长的一部分。要不要和我聊聊是什么让你有这种感受？{x}",
+    ("mentor", "angry"): "先深呼吸一下。愤怒背后往往藏着真正在意的东西，我们一起理一理？{x}",
+    ("trickster", "happy"): "哈哈，看你乐的！快说说，什么好事让我也沾沾喜气？{x}",
+    ("trickster", "sad"): "哎呀，小脸耷拉下来了？来来来，我讲个冷笑话给你暖暖场。{x}",
+    ("trickster", "angry"): "火气这么大，小心头顶冒烟哦～消消气，跟我吐槽一下？{x}",
+    ("guardian", "happy"): "看到你开心，我也跟着开心。这样的时刻值得好好记住。{x}",
+    ("guardian", "sad"): "没关系，我在这里陪着你。想说什么都可以，我会一直听着。{x}",
+    ("guardian", "angry"): "你的感受是合理的，先照顾好自己的情绪。我陪着你，慢慢来。{x}",
+}
+_FALLBACK_RESPONSE = "抱歉，我现在有点累。"
+
+# 技能关键词表：全部关键词编译成单个正则交替（最长优先），
+# 对输入做一次线性扫描即可分类，替代逐词 `in` 的 O(N·K) 重复扫描
+_SKILL_KEYWORDS = {
+    "记住": "long_term_memory_store",
+    "记录": "long_term_memory_store",
+    "别忘了": "long_term_memory_store",
+    "remember": "long_term_memory_store",
+    "还记得": "shared_experience_fetch",
+    "上次": "shared_experience_fetch",
+    "回忆": "shared_experience_fetch",
+    "我们一起": "shared_experience_fetch",
+}
+_SKILL_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_SKILL_KEYWORDS, key=len, reverse=True))
+)
+
+def match_skill_keyword(text: str) -> str | None:
+    """单遍扫描匹配技能关键词；未命中返回 None"""
+    m = _SKILL_RE.search(text)
+    return _SKILL_KEYWORDS[m.group(0)] if m else None
+
+# 本地词法情绪分类：很大一部分真实输入带有明确的情绪词面
+# （"开心"、"难过"、表情符号等），不值得为它们付一次 LLM 往返。
+# 结果按输入做 LRU 缓存，重复/口头禅式输入（"早安"）直接命中
+_EMOTION_LEXICON = {
+    Emotion.happy: ("开心", "高兴", "太好了", "太棒了", "哈哈", "😊", "😄", "happy"),
+    Emotion.sad: ("难过", "伤心", "想哭", "委屈", "😢", "😭", "sad"),
+    Emotion.angry: ("生气", "气死", "愤怒", "烦死", "😡", "angry"),
+}
+# 与技能关键词同样的做法：整张词表编译成一个正则交替（最长优先），
+# 一次线性扫描替代逐情绪逐词的 `in` 嵌套循环；命中词经边表反查情绪。
+# ASCII 词加 \b 词界，避免 "unhappy" 命中 "happy"
+_WORD2EMO = {w: e for e, words in _EMOTION_LEXICON.items() for w in words}
+_EMO_RE = re.compile(
+    "|".join(
+        rf"\b{re.escape(w)}\b" if w.isascii() else re.escape(w)
+        for w in sorted(_WORD2EMO, key=len, reverse=True)
+    )
+)
+# 命中词前的窗口里出现否定词时，词面情绪多半是反的（"不开心"、
+# "没高兴"、"not happy"、"isn't happy"）——快速路径不该自信地答错
+_NEGATORS = ("不", "没", "别", "not ", "n't")
+
+@functools.lru_cache(maxsize=4096)
+def classify_emotion_local(user_input_lc: str) -> Emotion | None:
+    """纯词法情绪判定；没有把握时返回 None，交给 LLM"""
+    m = _EMO_RE.search(user_input_lc)
+    if m is None:
+        return None
+    prefix = user_input_lc[max(0, m.start() - 4):m.start()]
+    if any(neg in prefix for neg in _NEGATORS):
+        return None
+    return _WORD2EMO[m.group(0)]
+
+# 技能的模拟实现：数据表是模块级常量，只构建一次，
+# 以自由函数注册，不经过类 + @staticmethod 的描述符间接层
+_MOCK_MEMORIES = {
+    "名字": "你叫小明，我记得的。",
+    "颜色": "你最喜欢蓝色。",
+    "生日": "你的生日是5月20日。",
+}
+_MOCK_EXPERIENCES = {
+    "天气": "上次我们聊天时外面下着小雨，你说你喜欢雨声。",
+    "音乐": "上次我们一起听了一首钢琴曲，你听得很安静。",
+}
+
+def long_term_memory_store(user_input: str) -> str:
+    for key, memory in _MOCK_MEMORIES.items():
+        if key in user_input:
+            return memory
+    return "好的，我记住了。"
+
+def shared_experience_fetch(user_input: str) -> str:
+    for key, memory in _MOCK_EXPERIENCES.items():
+        if key in user_input:
+            return memory
+    return "我们一起经历过很多呢。"
+
+_SKILLS = {
+    "long_term_memory_store": long_term_memory_store,
+    "shared_experience_fetch": shared_experience_fetch,
+}
+
+# 所有节点改为异步函数。
+# 节点只返回发生变化的键（delta）：pregel 只合并增量，
+# 避免每步对整个状态做 O(|state|) 的 diff/拷贝
+async def node_receive_input(state: CompanionState) -> dict:
+    log.debug("node=receive_input input=%r", state["user_input"])
+    # 小写转换只做一次，后续所有大小写不敏感的匹配直接用缓存
+    return {"user_input_lc": state["user_input"].lower()}
+
+async def node_classify(state: CompanionState) -> dict:
+    """单次结构化输出调用同时完成情绪分析与技能决策。
+
+    两个分类器针对的是同一条用户输入，拆成两次调用要付两倍的
+    HTTP 往返和 prompt prefill；合并成一次 JSON 输出调用后只剩一次。
+    关键词命中时技能判定以确定性结果优先（LLM 结果被覆盖）。
+    """
+    log.debug("node=classify")
+    # 本地快速路径：词法已能确定情绪时，技能交给确定性的关键词表，
+    # 整次分类 LLM 调用都省掉
+    local_emotion = classify_emotion_local(state["user_input_lc"])
+    if local_emotion is not None:
+        kw_skill = match_skill_keyword(state["user_input_lc"])
+        log.debug("classify_local emotion=%s skill=%s", local_emotion.name, kw_skill or "none")
+        return {
+            "detected_emotion": local_emotion,
+            "should_use_skill": kw_skill is not None,
+            "skill_to_use": kw_skill or "",
+            # 条件边跳过 execute_skill 时也要保证 skill_result 键存在
+            "skill_result": "",
+        }
+
+    emotion, skill = Emotion.neutral, "none"
     try:
-        res = await client.chat.completions.create(
-            model="gemini-3-flash-preview",
-            messages=[{"role": "system", "content": "判断是否需要工具：long_term_memory_store, shared_experience_fetch。不需要返回 none。"},
-                      {"role": "user", "content": state['user_input']}]
+        content = await _llm(
+            [*_CLASSIFY_MESSAGES_PREFIX,
+             {"role": "user", "content": state['user_input']}],
+            response_format={"type": "json_object"},
+            prompt_cache_key="classify",
         )
-        decision = res.choices[0].message.content.strip().lower()
+        parsed = orjson.loads(content)
+        emotion = _EMO_MAP.get(str(parsed.get("emotion", "")).lower(), Emotion.neutral)
+        skill = str(parsed.get("skill", "none")).lower()
     except Exception as e:
-        print(f"  ⚠️ 失败: {e}")
-        decision = "none"
-    
-    state["should_use_skill"] = "none" not in decision
-    state["skill_to_use"] = decision if state["should_use_skill"] else ""
-    print(f"  → 决策: {state['skill_to_use'] or '直接回复'}")
-    return state
+        log.warning("llm_call_failed err=%s", e)
+
+    kw_skill = match_skill_keyword(state["user_input_lc"])
+    if kw_skill is not None:
+        log.debug("skill_keyword_hit skill=%s", kw_skill)
+        skill = kw_skill
 
-async def node_execute_skill(state: CompanionState) -> CompanionState:
+    should_use = skill not in ("none", "")
+    log.debug("emotion=%s skill=%s", emotion.name, skill if should_use else "none")
+    return {
+        "detected_emotion": emotion,
+        "should_use_skill": should_use,
+        "skill_to_use": skill if should_use else "",
+        "skill_result": "",
+    }
+
+async def node_execute_skill(state: CompanionState) -> dict:
     if not state["should_use_skill"]:
-        state["skill_result"] = ""
-        return state
-    print(f"\n[节点 4] 执行技能...")
-    # 异步模拟技能执行
-    await asyncio.sleep(0.1) 
-    state["skill_result"] = "模拟数据：操作成功。"
-    return state
+        return {"skill_result": ""}
+    log.debug("node=execute_skill skill=%s", state["skill_to_use"])
+    skill = _SKILLS.get(state["skill_to_use"])
+    result = skill(state["user_input"]) if skill else "模拟数据：操作成功。"
+    return {"skill_result": result}
+
+async def _generate_response(state: CompanionState, on_delta=None) -> dict:
+    """流式生成回复：token 一到就通过 on_delta 回调吐出，同时累积出完整字符串。
 
-async def node_generate_response(state: CompanionState) -> CompanionState:
-    print(f"\n[节点 5] 生成回复...")
+    首 token 延迟由此从"整段生成完"降到"首个分片到达"；
+    on_delta 为 None 时行为等价于一次性取完整结果。
+    """
+    log.debug("node=generate_response")
     client = get_async_openai_client()
-    personality = PERSONALITY_MASKS[state["current_personality"]]
     try:
-        # 使用流式 API，但只取最终结果，以兼容 LangGraph 的状态更新模式
-        res = await client.chat.completions.create(
+        stream = await _limited_create(
+            client,
             model="gemini-3-flash-preview",
-            messages=[
-                {"role": "system", "content": personality["system_prompt"]},
-                {"role": "user", "content": f"情绪:{state['detected_emotion']}, 技能结果:{state['skill_result']}\n用户说:{state['user_input']}"}
-            ]
+            messages=[*_PERSONALITY_PREFIX[state["current_personality"]],
+                      {"role": "user", "content": _fmt_user_content(state)}],
+            stream=True,
+            extra_body={"prompt_cache_key": f"generate:{state['current_personality']}"},
         )
-        state["final_response"] = res.choices[0].message.content
+        chunks: list[str] = []
+        async for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                chunks.append(delta)
+                if on_delta is not None:
+                    await on_delta(delta)
+        final_response = "".join(chunks)
     except Exception as e:
-        print(f"  ⚠️ 失败: {e}")
-        state["final_response"] = "抱歉，我现在有点累。"
-    print(f"  → 回复: {state['final_response'][:30]}...")
-    return state
+        log.warning("llm_call_failed err=%s", e)
+        tpl = RESPONSE_TEMPLATES.get(
+            (state["current_personality"], state["detected_emotion"].name)
+        )
+        if tpl:
+            x = state["skill_result"] or ""
+            final_response = tpl.format(x=x).rstrip()
+        else:
+            final_response = _FALLBACK_RESPONSE
+    log.debug("response_preview=%r", final_response[:30])
+    return {"final_response": final_response}
+
+async def node_generate_response(state: CompanionState) -> dict:
+    """LangGraph 节点包装：流式累积，只把最终结果写入状态"""
+    return await _generate_response(state)
+
+async def node_update_history(state: CompanionState) -> dict:
+    # 调用方可以不提供历史通道（CLI 把历史交给检查点跨轮保管）：
+    # 首轮惰性创建定长环形缓冲
+    history = state.get("conversation_history")
+    if history is None:
+        history = deque(maxlen=_DEFAULT_HISTORY_MAXLEN)
+    history.append({"user": state["user_input"], "bot": state["final_response"]})
+    return {"conversation_history": history}
+
+async def batch_invoke(inputs: list[dict], poll_interval: float = 10.0,
+                       max_poll_interval: float = 300.0) -> list[str]:
+    """离线批量生成：把 N 条用户输入打包成一个 Batch API 作业。
+
+    适用于非交互场景（回放历史、离线评估）：一次上传 + 轮询取代
+    N 次实时往返，且批量端点按五折计费。inputs 的每个元素形如
+    {"user_input": ..., "current_personality": ...}；返回与 inputs
+    同序的回复文本列表。
+    """
+    client = get_async_openai_client()
+    lines = []
+    for i, item in enumerate(inputs):
+        personality = item.get("current_personality", "mentor")
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gemini-3-flash-preview",
+                "messages": [*_PERSONALITY_PREFIX[personality],
+                             {"role": "user", "content": item["user_input"]}],
+            },
+        }))
+
+    upload = await client.files.create(
+        file=("batch.jsonl", b"\n".join(lines)), purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=upload.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    # 指数退避轮询，直到作业进入终态
+    delay = poll_interval
+    while True:
+        batch = await client.batches.retrieve(batch.id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_poll_interval)
+    if batch.status != "completed":
+        raise RuntimeError(f"批量作业 {batch.id} 结束于状态 {batch.status}")
+
+    raw = (await client.files.content(batch.output_file_id)).content
+    results = [""] * len(inputs)
+    for line in raw.splitlines():
+        if not line:
+            continue
+        obj = orjson.loads(line)
+        idx = int(obj["custom_id"])
+        results[idx] = obj["response"]["body"]["choices"][0]["message"]["content"]
+    return results
+
+def serialize_history(history: deque) -> bytes:
+    """把会话历史序列化为 JSON bytes，供 API 返回或落盘。
+
+    deque 无法直接编码，先转 list；orjson 编码比 stdlib json 快数倍。
+    """
+    return orjson.dumps(list(history))
+
+# LangGraph 的 pregel 调度、状态合并和 reducer 机制对这条直线型流水线
+# 而言是纯框架开销。run_fast 按相同的节点顺序内联执行，每步之后回调
+# emit(node_name, delta)，与 companion_graph.astream 的逐步产出语义一致。
+# 需要条件分支、检查点等图能力时仍使用 LangGraph 版本
+USE_FAST_PATH = os.getenv("FAST_PATH", "1") == "1"
 
-async def node_update_history(state: CompanionState) -> CompanionState:
-    # 异步模拟历史记录更新
-    await asyncio.sleep(0.01)
-    state["conversation_history"].append({"user": state["user_input"], "bot": state["final_response"]})
+# 只有可能产出空结果（no-op）的技能才值得投机并行：当前注册的两个
+# 技能必然产出非空结果，投机请求注定被取消，白白占用一个 _LLM_SEM
+# 并发槽、一枚不可退还的限速令牌和 provider 侧的 prefill。
+# 接入真正可能 no-op 的技能时把名字加进这个集合
+_SPECULATIVE_SKILLS: frozenset[str] = frozenset()
+
+async def _act_and_generate(state: CompanionState, on_delta=None) -> tuple[dict, dict]:
+    """技能执行与回复生成的投机并行。
+
+    串行执行的端到端耗时是 T_skill + T_llm；这里在技能执行的同时，
+    先用空 skill_result 投机发起生成请求：技能产出为空（no-op）时
+    直接采纳投机结果，耗时变为 max(T_skill, T_llm)；产出非空时取消
+    投机请求，带着真实结果重发。投机流不向外吐 token，
+    避免可能作废的分片到达前端。
+    """
+    skill_task = asyncio.create_task(node_execute_skill(state))
+    spec_task = asyncio.create_task(_generate_response({**state, "skill_result": ""}))
+    skill_delta = await skill_task
+    if skill_delta["skill_result"]:
+        spec_task.cancel()
+        try:
+            await spec_task
+        except asyncio.CancelledError:
+            pass
+        gen_delta = await _generate_response({**state, **skill_delta}, on_delta)
+    else:
+        gen_delta = await spec_task
+    return skill_delta, gen_delta
+
+async def run_fast(state: CompanionState, emit=None, on_delta=None) -> CompanionState:
+    """绕过 pregel 的直连执行路径，拓扑与 build_companion_graph 保持一致。
+
+    state 就地更新并返回；emit(node_name, delta) 在每个节点完成后被 await；
+    on_delta(chunk) 在回复生成期间随每个流式分片被 await。
+    """
+    async def _step(name: str, delta: dict):
+        state.update(delta)
+        if emit is not None:
+            await emit(name, delta)
+
+    await _step("receive_input", await node_receive_input(state))
+    await _step("classify", await node_classify(state))
+    if state["should_use_skill"]:
+        if state["skill_to_use"] in _SPECULATIVE_SKILLS:
+            skill_delta, gen_delta = await _act_and_generate(state, on_delta)
+            await _step("execute_skill", skill_delta)
+            await _step("generate_response", gen_delta)
+        else:
+            await _step("execute_skill", await node_execute_skill(state))
+            await _step("generate_response", await _generate_response(state, on_delta))
+    else:
+        # 与图的条件边一致：无技能时不经过 execute_skill 节点
+        await _step("generate_response", await _generate_response(state, on_delta))
+    await _step("update_history", await node_update_history(state))
     return state
 
-def build_companion_graph():
+def build_companion_graph(checkpointer=None):
     graph = StateGraph(CompanionState)
     # 节点函数保持不变，但现在它们是异步的
     graph.add_node("receive_input", node_receive_input)
-    graph.add_node("analyze_emotion", node_analyze_emotion)
-    graph.add_node("decide_skill", node_decide_skill)
+    graph.add_node("classify", node_classify)
     graph.add_node("execute_skill", node_execute_skill)
     graph.add_node("generate_response", node_generate_response)
     graph.add_node("update_history", node_update_history)
-    graph.add_edge("receive_input", "analyze_emotion")
-    graph.add_edge("analyze_emotion", "decide_skill")
-    graph.add_edge("decide_skill", "execute_skill")
+    graph.add_edge("receive_input", "classify")
+    # 不需要技能时直接跳过 execute_skill 节点：省去一次节点调度
+    # 和状态快照（多数轮次都不触发技能），图的意图也更直观
+    graph.add_conditional_edges(
+        "classify",
+        lambda s: "execute_skill" if s["should_use_skill"] else "generate_response",
+        {"execute_skill": "execute_skill", "generate_response": "generate_response"},
+    )
     graph.add_edge("execute_skill", "generate_response")
     graph.add_edge("generate_response", "update_history")
     graph.add_edge("update_history", END)
     graph.set_entry_point("receive_input")
-    return graph.compile()
+    return graph.compile(checkpointer=checkpointer)
 
-if __name__ == "__main__":
-    # CLI 模式需要使用同步调用
-    import asyncio
-    
-    app = build_companion_graph()
+# 共享的已编译图按首次使用惰性编译（带进程内 MemorySaver 检查点）。
+# 与客户端的记忆化同一套路：import 时不付 build+compile 的代价 ——
+# API worker 走自己的 pickle 缓存路径，不该因为 import 本模块
+# 就额外编译一个用不上的图
+_APP = None
+
+def get_app():
+    """返回进程内共享的已编译图，首次调用时编译"""
+    global _APP
+    if _APP is None:
+        from langgraph.checkpoint.memory import MemorySaver
+        _APP = build_companion_graph(checkpointer=MemorySaver())
+    return _APP
+
+async def _cli_main() -> None:
+    """CLI 会话循环。整个循环必须跑在同一个事件循环里：共享的异步
+    客户端（连接池）、_LLM_SEM 和 _LLM_RATE 都绑定创建它们的循环，
+    按轮 asyncio.run 会让第二轮起的所有 LLM 调用死在已关闭的循环上，
+    然后被节点的兜底逻辑静默降级成模板回复。
+    """
+    app = get_app()
 
     print("=" * 60)
     print("欢迎使用伴伴机器人！")
@@ -181,13 +677,16 @@ if __name__ == "__main__":
             continue
 
         print("\n" + "=" * 60)
-        # 在同步环境中运行异步图
-        result = asyncio.run(app.ainvoke({
+        # 不传 conversation_history：该通道由检查点按 thread_id 跨轮保管，
+        # 每轮重新传空 deque 会把已积累的历史覆盖掉
+        result = await app.ainvoke({
             "user_input": user_input,
             "current_personality": personality,
-            "conversation_history": []
-        }))
+        }, config={"configurable": {"thread_id": "cli"}})
         print("=" * 60)
         print(f"\n【{PERSONALITY_MASKS[personality]['name']}】的回复：\n")
         print(result['final_response'])
         print("\n" + "=" * 60 + "\n")
+
+if __name__ == "__main__":
+    asyncio.run(_cli_main())